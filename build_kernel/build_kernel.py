@@ -2,56 +2,105 @@
 """ Script for building/installing new kernels """
 
 import os
+import re
 import sys
 import subprocess
 import shutil
 import argparse
-import configparser
+import threading
+import functools
+import importlib.util
 from subprocess import CalledProcessError
 from pathlib import Path
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-HAS_COLORAMA = 'colorama' in sys.modules
+HAS_COLORAMA = importlib.util.find_spec("colorama") is not None
 if HAS_COLORAMA:
     from colorama import init, Fore, Style
 
+# Matches kernel files like "vmlinuz-5.9.2-gentoo", "config-5.9.2-gentoo.old", or "System.map-5.9.2-gentoo-r2"
+# Groups: file type, version triple, release candidate number, .old suffix
+KERNEL_FILE_RE = re.compile(r"^(vmlinuz|System\.map|config)-(\d+\.\d+\.\d+)-gentoo(?:-r(\d+))?(\.old)?$")
+
+# Linux pipes hold 64 KiB by default, so there's never more than this to read from a child at once
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# Output prefixes never change, so build them once instead of on every message
+if HAS_COLORAMA:
+    INFO_PREFIX = Fore.GREEN + f"{sys.argv[0]}: " + Style.RESET_ALL
+    ERROR_PREFIX = Fore.RED + f"{sys.argv[0]}: " + Style.RESET_ALL + "Error! "
+else:
+    INFO_PREFIX = ""
+    ERROR_PREFIX = "Error! "
+
+
+# Messages can come from the cleanup workers and the post-install threads at the same time
+OUTPUT_LOCK = threading.Lock()
+
 
 def error_and_exit(error):
     """ print error then exit with return code 1 """
-    if HAS_COLORAMA:
-        print(Fore.RED + f"{sys.argv[0]}: " +
-              Style.RESET_ALL + f"Error! {error}, exiting...")
-    else:
-        print(f"Error! {error}, exiting...")
+    message = f"{ERROR_PREFIX}{error}, exiting...\n"
+    with OUTPUT_LOCK:
+        try:
+            sys.stdout.write(message)
+            sys.stdout.flush()
+        except OSError:
+            # stdout itself is what failed, e.g. the pager we were piped into was closed
+            sys.stderr.write(message)
     sys.exit(1)
 
 
 def script_info(info):
     """ print debugging info """
-    if HAS_COLORAMA:
-        print(Fore.GREEN + f"{sys.argv[0]}: " + Style.RESET_ALL + f"{info}")
-    else:
-        print(f"{info}")
+    with OUTPUT_LOCK:
+        sys.stdout.write(f"{INFO_PREFIX}{info}\n")
+        # Flushed so it lands in order with the command output written straight to sys.stdout.buffer
+        sys.stdout.flush()
+
+
+def parse_kernel_file_name(name: str):
+    """
+    Parse names like "vmlinuz-5.9.2-gentoo-r2.old" into (file_type, version_triple, release_candidate_num, is_old)
+    where file_type is one of "vmlinuz", "System.map", or "config"
+    Returns None if the name doesn't look like an installed kernel file
+    """
+    match = KERNEL_FILE_RE.match(name)
+    if match is None:
+        return None
+
+    file_type, version_triple, release_candidate, old = match.groups()
+    # 0 if there's no '-r[digit]' suffix
+    release_candidate_num = int(release_candidate) if release_candidate else 0
+    return (file_type, version_triple, release_candidate_num, old is not None)
 
 
+@dataclass(frozen=True, order=True)
 class VersionInfo:
     """ Container for organizing all the kernel versions and files """
 
-    def __init__(self, version_triple: str, vmlinuz: Path, system_map: Path, config: Path, is_old: bool,
-                 release_candidate_num: int = 0,
-                 kernel_modules_path: Path = "/lib/modules", kernel_source_path: Path = "/usr/src/linux"):
-        self.version_triple = version_triple
-        self.vmlinuz = vmlinuz
-        self.system_map = system_map
-        self.config = config
-        self.is_old = is_old
-        # 0 if not an explicit release candidate
-        # Expect it to be r[digit > 0]
-        self.release_candidate_num = release_candidate_num
-        self.__kernel_modules_path = kernel_modules_path
-        self.__kernel_source_path = kernel_source_path
-
-    def __repr__(self):
-        return "VersionInfo()"
+    # The generated comparisons only look at sort_key, which is filled in by __post_init__
+    sort_key: tuple = field(init=False, repr=False)
+    version_triple: str = field(compare=False)
+    vmlinuz: Path = field(compare=False)
+    system_map: Path = field(compare=False)
+    config: Path = field(compare=False)
+    is_old: bool = field(compare=False)
+    # 0 if not an explicit release candidate
+    # Expect it to be r[digit > 0]
+    release_candidate_num: int = field(default=0, compare=False)
+    kernel_modules_path: Path = field(default=Path("/lib/modules"), compare=False, repr=False)
+    kernel_source_path: Path = field(default=Path("/usr/src/linux"), compare=False, repr=False)
+
+    def __post_init__(self):
+        # X . Y . Z
+        major, minor, patch = map(int, self.version_triple.split(sep="."))
+        # is .old, penalize it in the sorting by making this -1
+        # is NOT .old, give it an advantage in sorting by making this 0
+        old_adj = -1 if self.is_old else 0
+        object.__setattr__(self, "sort_key",
+                           (major, minor, patch, int(self.release_candidate_num), old_adj))
 
     def __str__(self):
         out = f"VersionInfo({self.version_triple}"
@@ -66,74 +115,61 @@ class VersionInfo:
 
     def as_tuple(self):
         """ Convert VersionInfo into a tuple """
+        return self.sort_key
 
-        # Indices:
-        # 0 1 2 3 4
-        # X . Y . Z
-        version_triple_split = self.version_triple.split(sep=".")
-        major = version_triple_split[0]  # X
-        minor = version_triple_split[1]  # Y
-        patch = version_triple_split[2]  # Z
-        if self.is_old:
-            # is .old, penalize it in the sorting by making this -1
-            old_adj = -1
-        else:
-            # is NOT .old, give it an advantage in sorting by making this 0
-            old_adj = 0
-
-        return (int(major), int(minor), int(patch), int(self.release_candidate_num), int(old_adj))
-
-    def remove(self, trash_path: Path):
-
-        def get_trash_cmd(file):
-            # TODO Get trash-cli working across partitions
-            # return ["trash-put", f"{str(file)}", f"--trash-dir={trash_path}"]
-            return ["rm", "-r", f"{str(file)}"]
-
-        if self.is_old:
-            script_info(
-                f"Deleting version {self.version_triple}.old")
-        else:
-            script_info(
-                f"Deleting version {self.version_triple}")
+    def remove(self, trash_path: Path, remove_source: bool = True):
+        """
+        delete this version's files from the install path along with its source and modules directories
+        remove_source=False leaves the source directory for a kept kernel of the same version
+        """
+        # TODO Get trash-cli working across partitions
+        # subprocess.run(["trash-put", f"{str(file)}", f"--trash-dir={trash_path}"], check=True)
+        # Deleting outright for now
 
-        for f in [self.vmlinuz.absolute(), self.system_map.absolute(), self.config.absolute()]:
-            script_info(
-                f"Deleting file {str(f)}")
-            subprocess.run(get_trash_cmd(f), check=True)
+        files = [self.vmlinuz, self.system_map, self.config]
 
-        source_dir = str(
-            f"{str(self.__kernel_source_path)}-{self.version_triple}-gentoo")
+        # Both the source and modules directories are named X.Y.Z-gentoo[-rN]
+        kernel_name = f"{self.version_triple}-gentoo"
         if int(self.release_candidate_num) > 0:
-            source_dir += f"-r{self.release_candidate_num}"
-
-        script_info(f"Deleting source directory {str(source_dir)}")
-        subprocess.run(get_trash_cmd(source_dir), check=True)
+            kernel_name += f"-r{self.release_candidate_num}"
+        # /usr/src/linux -> /usr/src/linux-X.Y.Z-gentoo[-rN]
+        source_dir = self.kernel_source_path.with_name(f"{self.kernel_source_path.name}-{kernel_name}")
 
-        if not self.is_old:
+        if self.is_old:
             # Assume that there's a non .old kernel that's using the modules
-            modules_dir = Path(
-                f"{self.__kernel_modules_path}/{self.version_triple}-gentoo")
-            script_info(f"Deleting kernel modules in {str(modules_dir)}")
-            subprocess.run(get_trash_cmd(modules_dir), check=True)
-
-    def __eq__(self, other):
-        return self.as_tuple() == other.as_tuple()
-
-    def __ne__(self, other):
-        return self.as_tuple() != other.as_tuple()
-
-    def __gt__(self, other):
-        return self.as_tuple() > other.as_tuple()
-
-    def __ge__(self, other):
-        return self > other or self == other
+            modules_dir = None
+        else:
+            modules_dir = self.kernel_modules_path / kernel_name
+
+        # Log everything that's about to go in one message rather than a print per path
+        old_suffix = ".old" if self.is_old else ""
+        lines = [f"Deleting version {self.version_triple}{old_suffix}"]
+        lines += [f"    Deleting file {f}" for f in files]
+        if remove_source:
+            lines.append(f"    Deleting source directory {source_dir}")
+        if modules_dir is not None:
+            lines.append(f"    Deleting kernel modules in {modules_dir}")
+        script_info("\n".join(lines))
 
-    def __lt__(self, other):
-        return self.as_tuple() < other.as_tuple()
+        try:
+            # Plain files, unlink them directly instead of forking a process for each one
+            # These are already joined onto the install path when found, no need for .absolute()
+            for f in files:
+                os.unlink(f)
+        except OSError as err:
+            error_and_exit(err)
 
-    def __le__(self, other):
-        return self < other or self == other
+        # A source tree is tens of thousands of files, let a single rm walk both trees
+        # rather than paying Python's per-entry overhead in shutil.rmtree
+        dirs = [source_dir] if remove_source else []
+        if modules_dir is not None:
+            dirs.append(modules_dir)
+        if not dirs:
+            return
+        try:
+            subprocess.run(["rm", "-rf", "--", *map(str, dirs)], stdin=subprocess.DEVNULL, check=True)
+        except CalledProcessError as err:
+            error_and_exit(err)
 
 
 class KernelUpdater:
@@ -143,18 +179,32 @@ class KernelUpdater:
     """
 
     def __init__(self, manual_edit: bool, install_path: Path, kernel_source_path: Path, kernel_modules_path: Path,
-                 versions_to_keep: int, clean_only: bool, gen_grub_config: bool, trash_path: Path, emerge_module_rebuild: bool):
+                 versions_to_keep: int, clean_only: bool, gen_grub_config: bool, trash_path: Path, emerge_module_rebuild: bool,
+                 no_parallel: bool = True):
         self.__manual_edit = manual_edit
-        self.__install_path = install_path
-        self.__kernel_source_path = kernel_source_path
-        self.__kernel_modules_path = kernel_modules_path
-        self.__trash_path = trash_path
+        # These come out of the conf file as strings, convert them once here
+        self.__install_path = Path(install_path)
+        self.__kernel_source_path = Path(kernel_source_path)
+        self.__kernel_modules_path = Path(kernel_modules_path)
+        self.__trash_path = Path(trash_path)
         self.__versions_to_keep = versions_to_keep
         self.__clean_only = clean_only
         self.__gen_grub_config = gen_grub_config
         self.__emerge_module_rebuild = emerge_module_rebuild
+        self.__no_parallel = no_parallel
+        # Job count and load average for make, only counting the CPUs this process may run on
+        self.__nproc = len(os.sched_getaffinity(0))
         self.__current_kernels: List[VersionInfo] = []
-        self.__find_installed_kernels()
+        # Set whenever the install path changes on disk and __current_kernels needs a rescan
+        # Starts dirty so the first use of __kernels does the initial scan
+        self.__kernels_dirty = True
+
+    @property
+    def __kernels(self) -> List[VersionInfo]:
+        """ installed kernels sorted newest to oldest, only rescanning if the install path changed """
+        if self.__kernels_dirty:
+            self.__find_installed_kernels()
+        return self.__current_kernels
 
     def __check_perm(self):
         """ ensure that the user is seen as root """
@@ -165,179 +215,261 @@ class KernelUpdater:
 
     def __update_config(self):
         """ syncing configuration to new kernel """
-        os.chdir(str(self.__kernel_source_path))
-
         # Could get running config from /proc/config.gz but I'll just copy the newest one in /boot
-        # The newest config we have
-        src = self.__install_path / self.__current_kernels[0].config
-        dest = Path(os.getcwd() + "/.config")
-
-        script_info(f"Copying {src.absolute()} to {dest.absolute()}")
+        # The newest config we have, already a full path into the install path
+        src = self.__kernels[0].config
+        dest = self.__kernel_source_path / ".config"
+
+        script_info(f"Copying {src} to {dest}")
+        # Always a real copy, a hard link can outlive make oldconfig ("No change to .config" skips its rename)
+        # and let edits to .config reach the installed config. Usually /boot is FAT anyway, where linking can't work.
+        # Unlinked first so the copy never writes through a link left by an older version of this script
+        if dest.exists():
+            dest.unlink()
         shutil.copy(src, dest)
 
         script_info(f"Creating a new config using .config as a base")
-        try:
-            subprocess.run(["make", "oldconfig"], check=True)
-        except CalledProcessError as err:
-            error_and_exit(err)
+        # oldconfig prompts for any new options, so it needs the terminal
+        self.__run(["make", "oldconfig"], cwd=str(self.__kernel_source_path), stdin=None)
 
     def __compile_kernel(self):
         """ compile just the kernel """
-        os.chdir(str(self.__kernel_source_path))
-        script_info(f"Compiling kernel in {os.getcwd()}")
+        script_info(f"Compiling kernel in {self.__kernel_source_path}")
+        self.__run_streamed(["make", f"--jobs={self.__nproc}", f"--load-average={self.__nproc}"],
+                            cwd=str(self.__kernel_source_path))
+
+    def __run(self, cmd: List[str], **kwargs):
+        """
+        run a command, exit if it fails
+        stdin defaults to /dev/null, pass stdin=None for commands that prompt the user.
+        Our own fds are already non-inheritable so the child doesn't need to close every fd on startup
+        """
+        kwargs.setdefault("stdin", subprocess.DEVNULL)
+        kwargs.setdefault("close_fds", False)
+        # Fully buffered, only matters if output is ever captured here instead of inherited
+        kwargs.setdefault("bufsize", -1)
         try:
-            subprocess.run(
-                ["/bin/bash", "-c", "\"make\" --jobs $(nproc) --load-average $(nproc)"], check=True)
+            return subprocess.run(cmd, check=True, **kwargs)
         except CalledProcessError as err:
             error_and_exit(err)
 
+    def __run_streamed(self, cmd: List[str], **kwargs):
+        """
+        run a command with its output piped through a helper thread, exit if it fails
+        The command never blocks on writes to a slow terminal, the thread takes the backpressure instead
+        """
+        sys.stdout.flush()
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   bufsize=PIPE_CHUNK_SIZE, close_fds=False, **kwargs)
+
+        # Set by the pump if our own stdout fails, e.g. the pager or tee we're piped into went away
+        write_errors = []
+
+        def copy_output():
+            # read1 returns whatever is buffered so output still shows up as it's produced,
+            # while a busy build is still drained a full pipe at a time
+            # Each chunk is written as soon as it arrives so prompts (emerge --ask, kconfig NEW options) show up.
+            # Writing under the lock keeps messages from other threads whole, though one can still
+            # land between two chunks of the same line
+            for chunk in iter(functools.partial(process.stdout.read1, PIPE_CHUNK_SIZE), b""):
+                if write_errors:
+                    # Keep draining so the command never blocks on a full pipe
+                    continue
+                try:
+                    with OUTPUT_LOCK:
+                        sys.stdout.buffer.write(chunk)
+                        sys.stdout.buffer.flush()
+                except OSError as err:
+                    write_errors.append(err)
+
+        pump = threading.Thread(target=copy_output, daemon=True)
+        pump.start()
+        returncode = process.wait()
+        pump.join()
+        if returncode != 0:
+            error_and_exit(CalledProcessError(returncode, cmd))
+        if write_errors:
+            error_and_exit(f"Could not write the output of {' '.join(cmd)}: {write_errors[0]}")
+
     def __install_new_kernel(self):
         """ install modules and kernel image itself """
-        os.chdir(str(self.__kernel_source_path))
-
+        # One after the other, installkernel's hooks (dracut, depmod) read the modules that modules_install writes
         script_info("Installing modules")
-        try:
-            subprocess.run(["make", "modules_install"], check=True)
-        except CalledProcessError as err:
-            error_and_exit(err)
-
+        self.__run(["make", "modules_install"], cwd=str(self.__kernel_source_path))
         script_info(
             f"Installing kernel image, system map, and config to {str(self.__install_path)}")
-        try:
-            # This copies over the system environment but appends the INSTALL_PATH variable
-            # needed during "make install"
-            subprocess.run(["/bin/bash", "-c", "\"make\" install"],
-                           env=dict(os.environ, INSTALL_PATH=str(self.__install_path)), check=True)
-        except CalledProcessError as err:
-            error_and_exit(err)
+        # This copies over the system environment but appends the INSTALL_PATH variable
+        # needed during "make install"
+        self.__run(["make", "install"], cwd=str(self.__kernel_source_path),
+                   env=dict(os.environ, INSTALL_PATH=str(self.__install_path)))
+        self.__kernels_dirty = True
 
     def __recompile_extra_modules(self):
         """ recompile out-of-tree modules included by portage (nvidia-drivers) """
-        os.chdir(str(self.__kernel_source_path))
         script_info("Recompiling modules from portage")
+        # Portage prefers the environment over make.conf, so only hand the out-of-tree module builds
+        # every core when make.conf doesn't already set MAKEOPTS.
+        # EMERGE_DEFAULT_OPTS is left alone, --jobs on top of -jN would allow N*N compilers at once
+        env = dict(os.environ)
+        if not self.__portage_var("MAKEOPTS"):
+            env["MAKEOPTS"] = f"-j{self.__nproc} -l{self.__nproc}"
+        self.__run_streamed(["emerge", "@module-rebuild"], cwd=str(self.__kernel_source_path), env=env)
+
+    def __portage_var(self, name: str):
+        """ value of a variable as portage sees it (environment, then make.conf), empty if it can't be read """
         try:
-            subprocess.run(["emerge", "@module-rebuild"], check=True)
-        except CalledProcessError as err:
-            error_and_exit(err)
+            result = subprocess.run(["portageq", "envvar", name], stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        except (OSError, CalledProcessError):
+            return ""
+        return result.stdout.decode().strip()
+
+    def __clean_up_and_regenerate_grub(self):
+        """ delete old kernels, then point grub at whatever is left """
+        self.__clean_up(self.__trash_path)
+        if self.__gen_grub_config:
+            self.__grub_mk_config()
+
+    def __run_post_install(self):
+        """
+        rebuild the portage modules against the newly installed modules
+        while old kernels are cleaned up on another thread
+        """
+        if self.__no_parallel:
+            if self.__emerge_module_rebuild:
+                self.__recompile_extra_modules()
+            self.__clean_up_and_regenerate_grub()
+            return
+        # Cleanup doesn't touch the new kernel's modules so it can overlap with the rebuild.
+        # grub-mkconfig scans the install path so it has to wait for the cleanup, it runs on the same worker
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            steps = [executor.submit(self.__clean_up_and_regenerate_grub)]
+            if self.__emerge_module_rebuild:
+                steps.append(executor.submit(self.__recompile_extra_modules))
+            # Re-raises the SystemExit from error_and_exit if either step failed.
+            # Leaving the with block still waits for the other step on purpose, exiting wouldn't stop
+            # a running emerge and a half finished cleanup is worse than a late exit
+            for step in steps:
+                step.result()
+
+    def __scan_install_path(self):
+        """
+        Read the install directory once and bucket the kernel files in it
+        Returns the vmlinuz, System.map, and config entries, each keyed by (version_triple, release_candidate_num, is_old)
+        """
+        # Bucket the vmlinuz, config, and system map files by (version_triple, release_candidate_num, is_old)
+        vmlinuz_by_key = {}
+        sysmap_by_key = {}
+        config_by_key = {}
+        buckets = {"vmlinuz": vmlinuz_by_key, "System.map": sysmap_by_key, "config": config_by_key}
+        # DirEntry.is_file() uses the file type from the directory read, no extra stat per entry
+        # This also skips directories like grub/ without trying to parse them
+        with os.scandir(str(self.__install_path)) as it:
+            entries = [entry for entry in it if entry.is_file()]
+
+        for entry in entries:
+            # One regex match both classifies the file and gives the exact key to match it up with,
+            # so a 5.9.2 file never gets mistaken for 5.9.20
+            parsed = parse_kernel_file_name(entry.name)
+            if parsed is None:
+                # Other files in the install path are fine, but a gentoo vmlinuz we can't parse is not
+                if entry.name.startswith("vmlinuz-") and "-gentoo" in entry.name:
+                    error_and_exit(
+                        f"Could not parse a kernel version out of {entry.name}!")
+                continue
+
+            file_type, version_triple, release_candidate_num, is_old = parsed
+            buckets[file_type][(version_triple, release_candidate_num, is_old)] = entry
+
+        return vmlinuz_by_key, sysmap_by_key, config_by_key
 
     def __find_installed_kernels(self):
         """
         Get a set of all the versions and .olds
             - X.Y.Z[.old] preserve the .old aspect if there
-        vmlinuzes: a list or generator of strings like "vmlinuz-5.7.5-gentoo.old"
+        Matches each vmlinuz to its System.map and config
         """
         # Reset current list
         self.__current_kernels = []
-        os.chdir(str(self.__install_path))
         script_info(
-            f"Searching for installed kernel files in {os.getcwd()}...")
-
-        # Find all vmlinuz, config, and system map files
-        vmlinuzes = list(Path().glob("vmlinuz-*-gentoo*"))
-        system_maps = list(Path().glob("System.map*"))
-        configs = list(Path().glob("config*"))
+            f"Searching for installed kernel files in {self.__install_path}...")
+        vmlinuz_by_key, sysmap_by_key, config_by_key = self.__scan_install_path()
 
-        """
-        # Eh, this won't work if im trying to fix a broken setup where there's a mismatch
         # Ensure that the 3 lists are the same length
-        if not len(list(vmlinuzes)) == len(list(system_maps)) and len(list(system_maps)) == len(list(configs)):
-            error_and_exit(f"There are {len(list(vmlinuzes))} vmlinuz files, {len(list(system_maps))} "
-                           + f"system maps, and {len(list(configs))} config files")
-        """
-
-        for vmlinuz in vmlinuzes:
-            version_triple = str(vmlinuz).split(
-                sep="-")  # Split up the vmlinuz string
-
-            # len of 3 is normal, len of 4 is release candidate
-            if len(version_triple) not in [3, 4]:
-                error_and_exit(
-                    f"Expected len(version) == 3 or 4, got {len(version_triple)} for version_triple {version_triple}!")
-
-            if len(version_triple) == 4:
-                # Example, grab '2' from '-r2'
-                release_candidate_num = str(version_triple[3]).lstrip('r')
-            else:
-                release_candidate_num = 0
+        # Only warn, erroring out won't work if im trying to fix a broken setup where there's a mismatch.
+        # Each vmlinuz still errors out below if its own System.map or config is missing
+        n_v, n_s, n_c = len(vmlinuz_by_key), len(sysmap_by_key), len(config_by_key)
+        if not (n_v == n_s == n_c):
+            script_info(f"Warning! There are {n_v} vmlinuz files, {n_s} "
+                        + f"system maps, and {n_c} config files")
 
-            # extract the '5.9.2' from 'vmlinuz-5.9.2-gentoo'
-            version_triple = version_triple[1]
+        for key, vmlinuz in vmlinuz_by_key.items():
+            version_triple, release_candidate_num, is_old = key
+            old_suffix = ".old" if is_old else ""
 
-            is_old = bool(vmlinuz.suffix == '.old')
             # Find the accompying System.map and config
-            system_maps = Path().glob("System.map*")
-            configs = Path().glob("config*")
-            if is_old:
-                # Note: .pop() is a lazy way to convert a single-element list to the underlying type
-                #
-                # Be extra sure that the suffix is .old
-                try:
-                    system_map = [s for s in system_maps if version_triple in str(
-                        s) and str(s).endswith(".old")].pop()
-                except:
-                    error_and_exit(
-                        f"Could not find a system_map for {version_triple}.old!")
-
-                try:
-                    config = [s for s in configs if version_triple in str(
-                        s) and str(s).endswith(".old")].pop()
-                except:
-                    error_and_exit(
-                        f"Could not find a config for {version_triple}.old!")
-            else:
-                # Ensure that the suffix isn't .old
-                try:
-                    system_map = [s for s in system_maps if version_triple in str(
-                        s) and not str(s).endswith(".old")].pop()
-                except:
-                    error_and_exit(
-                        f"Could not find a system_map for {version_triple}!")
+            system_map = sysmap_by_key.get(key)
+            if system_map is None:
+                error_and_exit(
+                    f"Could not find a system_map for {version_triple}{old_suffix}!")
 
-                try:
-                    config = [s for s in configs if version_triple in str(
-                        s) and not str(s).endswith(".old")].pop()
-                except:
-                    error_and_exit(
-                        f"Could not find a config for {version_triple}!")
+            config = config_by_key.get(key)
+            if config is None:
+                error_and_exit(
+                    f"Could not find a config for {version_triple}{old_suffix}!")
 
             self.__current_kernels.append(VersionInfo(
-                version_triple=version_triple, vmlinuz=vmlinuz, system_map=system_map, config=config, is_old=is_old,
-                kernel_modules_path=self.__kernel_modules_path, release_candidate_num=release_candidate_num))
+                version_triple=version_triple, vmlinuz=Path(vmlinuz.path), system_map=Path(system_map.path),
+                config=Path(config.path), is_old=is_old,
+                kernel_modules_path=self.__kernel_modules_path, kernel_source_path=self.__kernel_source_path,
+                release_candidate_num=release_candidate_num))
 
-        self.__current_kernels = sorted(self.__current_kernels, reverse=True)
+        self.__current_kernels = sorted(self.__current_kernels, key=VersionInfo.as_tuple, reverse=True)
+        self.__kernels_dirty = False
 
     def __grub_mk_config(self):
         """ Generate grub config """
-        grub_cfg_location = f"{self.__install_path}/grub/grub.cfg"
+        grub_cfg_location = self.__install_path / "grub" / "grub.cfg"
         script_info(f"Regenerating grub configuration at {grub_cfg_location}")
 
-        try:
-            subprocess.run(
-                ["grub-mkconfig", "-o", grub_cfg_location], check=True)
-        except CalledProcessError as err:
-            error_and_exit(err)
+        self.__run(["grub-mkconfig", "-o", grub_cfg_location])
 
     def __clean_up(self, trash_path: Path):
         """ delete old kernels """
 
-        self.__find_installed_kernels()
+        # Only rescans if a new kernel was installed since the last scan
+        kernels = self.__kernels
 
-        # If there's MAX_VERSIONS_TO_KEEP or less versions, exit
-        if len(self.__current_kernels) <= len(self.__versions_to_keep):
+        # If there's VersionsToKeep or less versions, exit
+        if len(kernels) <= self.__versions_to_keep:
             script_info(
-                f"Only {len(self.__current_kernels)} kernels are there, not deleting any")
+                f"Only {len(kernels)} kernels are there, not deleting any")
             return
 
-        # Otherwise delete everything but the 2 newest versions
-        # Sort them by age
+        # Otherwise delete everything but the VersionsToKeep newest versions
+        # __find_installed_kernels already sorted them by age
         # The lowest values (newest) should be first, and highest (oldest) at the end
         self.print_installed_kernels()
 
         # Also delete the accompying System map and configs
-        num_to_delete = len(self.__current_kernels) - 2
+        num_to_delete = len(kernels) - self.__versions_to_keep
         script_info(f"Deleting {num_to_delete} old kernel versions...")
-        for _ in range(num_to_delete):
-            self.__current_kernels.pop().remove(trash_path=trash_path)
+        # Sorted newest first, so the oldest versions are the tail of the list
+        victims = kernels[self.__versions_to_keep:]
+        # A .old kernel shares its source directory with the non .old kernel of the same version,
+        # which may be the one that was just built, so leave it if that kernel is being kept
+        kept_sources = {(k.version_triple, k.release_candidate_num)
+                        for k in kernels[:self.__versions_to_keep] if not k.is_old}
+        # Each version's files and directories are independent and deleting them is I/O bound,
+        # so remove the versions in parallel. Each worker mostly waits on its own rm, a few are plenty.
+        # Iterating the results re-raises any error_and_exit from a worker
+        with ThreadPoolExecutor(max_workers=min(4, len(victims))) as executor:
+            list(executor.map(lambda kernel_to_delete: kernel_to_delete.remove(
+                trash_path=trash_path,
+                remove_source=(kernel_to_delete.version_triple, kernel_to_delete.release_candidate_num)
+                not in kept_sources), victims))
+        # The install path changed on disk, the next use of __kernels rescans it
+        self.__kernels_dirty = True
 
     def update(self):
         """ Run all of the private methods in the proper order """
@@ -356,29 +488,41 @@ class KernelUpdater:
 
         self.__compile_kernel()
         self.__install_new_kernel()
-        if self.__emerge_module_rebuild:
-            self.__recompile_extra_modules()
-        self.__clean_up(self.__trash_path)
-        if self.__gen_grub_config:
-            self.__grub_mk_config()
+        self.__run_post_install()
 
     def print_installed_kernels(self):
-        """ Print all of the available kernels  """
-        self.__current_kernels = sorted(self.__current_kernels, reverse=True)
+        """ Print all of the available kernels, already sorted by __find_installed_kernels """
+        # Scan first so the search message doesn't land between the header and the list
+        kernels = self.__kernels
         script_info(f"sorted version_infos (newest to oldest):")
-        for v in self.__current_kernels:
+        for v in kernels:
             script_info(f"    {v}")
 
 
+TRUE_STRINGS = frozenset({"true", "t", "1", "on", "yes"})
+FALSE_STRINGS = frozenset({"false", "f", "0", "off", "no"})
+
+
 def str_to_bool(string: str):
-    if string.lower() in ["true", "t", "1", "on", "yes"]:
+    lowered = string.lower()
+    if lowered in TRUE_STRINGS:
         return True
-    elif string.lower() in ["false", "f", "0", "off", "no"]:
+    elif lowered in FALSE_STRINGS:
         return False
     else:
         raise TypeError(f"Could not parse {string} as boolean")
 
 
+def parse_versions_to_keep(string: str):
+    try:
+        versions_to_keep = int(string)
+    except ValueError:
+        raise ValueError(f"VersionsToKeep must be a number, got {string}")
+    if versions_to_keep < 1:
+        raise ValueError(f"VersionsToKeep must be at least 1, got {versions_to_keep}")
+    return versions_to_keep
+
+
 if __name__ == '__main__':
     """ main """
     parser = argparse.ArgumentParser(
@@ -393,8 +537,16 @@ if __name__ == '__main__':
     parser.add_argument(
         '-l', '--list', dest='list', action='store_true',
         help="List installed kernels and then exit")
-    parser.set_defaults(manual_edit=False, clean_only=False, list=False)
+    parser.add_argument(
+        '-s', '--no-parallel', dest='no_parallel', action='store_true',
+        help="Run the module rebuild, cleanup, and grub config generation one after another (default)")
+    parser.add_argument(
+        '-p', '--parallel', dest='no_parallel', action='store_false',
+        help="Clean up old kernels and regenerate the grub config while the module rebuild runs")
+    parser.set_defaults(manual_edit=False, clean_only=False, list=False, no_parallel=True)
     args = parser.parse_args()
+    # Only needed once we're past --help and argument errors
+    import configparser
 
     if HAS_COLORAMA:
         init()  # Init colorama, not necessarily needed for Linux but why not
@@ -427,42 +579,36 @@ if __name__ == '__main__':
 
     script_info(f"Using conf file {str(config_file)}")
     config.read(str(config_file))
-    # Any of these will throw if there's an issue
-    try:
-        install_path = config["paths"]["InstallPath"]
-    except ValueError:
-        error_and_exit("No InstallPath was configured!")
-
-    try:
-        source_path = config["paths"]["KernelSourcePath"]
-    except ValueError:
-        error_and_exit("No KernelSourcePath was configured!")
-
-    try:
-        modules_path = config["paths"]["KernelModulesPath"]
-    except ValueError:
-        error_and_exit("No KernelModulesPath was configured!")
-    try:
-        trash_path = config["paths"]["TrashPath"]
-    except ValueError:
-        error_and_exit("No TrashPath was configured!")
-
-    try:
-        versions_to_keep = config["settings"]["VersionsToKeep"]
-    except ValueError:
-        error_and_exit("No VersionsToKeep was configured!")
+    # Collect every missing key so they can all be reported at once
+    missing_keys = []
+
+    def read_setting(section: str, key: str):
+        value = config.get(section, key, fallback=None)
+        if value is None:
+            missing_keys.append(f"[{section}] {key}")
+        return value
+
+    install_path = read_setting("paths", "InstallPath")
+    source_path = read_setting("paths", "KernelSourcePath")
+    modules_path = read_setting("paths", "KernelModulesPath")
+    trash_path = read_setting("paths", "TrashPath")
+    versions_to_keep = read_setting("settings", "VersionsToKeep")
+    gen_grub_config = read_setting("settings", "RegenerateGrubConfig")
+    emerge_module_rebuild = read_setting("settings", "EmergeModuleRebuild")
+    if missing_keys:
+        error_and_exit(
+            f"{str(config_file)} is missing {', '.join(missing_keys)}")
 
     try:
-        gen_grub_config = str_to_bool(
-            config["settings"]["RegenerateGrubConfig"])
-    except ValueError:
-        error_and_exit("RegenerateGrubConfig was not configured!")
+        versions_to_keep = parse_versions_to_keep(versions_to_keep)
+    except ValueError as err:
+        error_and_exit(err)
 
     try:
-        emerge_module_rebuild = str_to_bool(
-            config["settings"]["EmergeModuleRebuild"])
-    except ValueError:
-        error_and_exit("EmergeModuleRebuild was not configured!")
+        gen_grub_config = str_to_bool(gen_grub_config)
+        emerge_module_rebuild = str_to_bool(emerge_module_rebuild)
+    except TypeError as err:
+        error_and_exit(err)
 
     updater = KernelUpdater(manual_edit=args.manual_edit,
                             install_path=install_path,
@@ -472,7 +618,8 @@ if __name__ == '__main__':
                             clean_only=args.clean_only,
                             gen_grub_config=gen_grub_config,
                             trash_path=trash_path,
-                            emerge_module_rebuild=emerge_module_rebuild)
+                            emerge_module_rebuild=emerge_module_rebuild,
+                            no_parallel=args.no_parallel)
     if args.list == True:
         script_info(
             "Listing installed kernels and then exiting...")
@@ -2,7 +2,10 @@
 
 """ Tests build_kernel.py """
 
+import os
+import tempfile
 import unittest
+from pathlib import Path
 import build_kernel
 
 
@@ -53,6 +56,98 @@ class TestBuildKernel(unittest.TestCase):
                                        system_map="System.map-5.7.10-gentoo", config="config-5.7.10-gentoo", release_candidate_num=15, is_old=False)
         self.assertGreater(new, old)
 
+    def test_parse_kernel_file_name(self):
+        self.assertEqual(build_kernel.parse_kernel_file_name("vmlinuz-5.9.2-gentoo"),
+                         ("vmlinuz", "5.9.2", 0, False))
+        self.assertEqual(build_kernel.parse_kernel_file_name("System.map-5.9.2-gentoo.old"),
+                         ("System.map", "5.9.2", 0, True))
+        self.assertEqual(build_kernel.parse_kernel_file_name("config-5.9.20-gentoo-r2.old"),
+                         ("config", "5.9.20", 2, True))
+        self.assertIsNone(build_kernel.parse_kernel_file_name("config"))
+        self.assertIsNone(build_kernel.parse_kernel_file_name("initramfs-5.9.2-gentoo.img"))
+
+    def test_parse_versions_to_keep(self):
+        self.assertEqual(build_kernel.parse_versions_to_keep("3"), 3)
+        self.assertEqual(build_kernel.parse_versions_to_keep("12"), 12)
+        self.assertRaises(ValueError, build_kernel.parse_versions_to_keep, "0")
+        self.assertRaises(ValueError, build_kernel.parse_versions_to_keep, "three")
+
+
+class TestKernelUpdater(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        root = Path(self.tmp_dir.name)
+        self.install_path = root / "boot"
+        self.source_path = root / "src"
+        self.modules_path = root / "modules"
+        for path in (self.install_path, self.source_path, self.modules_path):
+            path.mkdir()
+        # grub's directory lives in the install path too and should be left alone
+        (self.install_path / "grub").mkdir()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def install(self, version_triple: str, old: bool = False, release_candidate_num: int = 0):
+        kernel_name = f"{version_triple}-gentoo"
+        if release_candidate_num > 0:
+            kernel_name += f"-r{release_candidate_num}"
+        suffix = ".old" if old else ""
+        for prefix in ("vmlinuz", "System.map", "config"):
+            (self.install_path / f"{prefix}-{kernel_name}{suffix}").touch()
+        (self.source_path / f"linux-{kernel_name}").mkdir(exist_ok=True)
+        (self.modules_path / kernel_name).mkdir(exist_ok=True)
+
+    def updater(self, versions_to_keep: int):
+        return build_kernel.KernelUpdater(manual_edit=False, install_path=str(self.install_path),
+                                          kernel_source_path=str(self.source_path / "linux"),
+                                          kernel_modules_path=str(self.modules_path),
+                                          versions_to_keep=versions_to_keep, clean_only=True, gen_grub_config=False,
+                                          trash_path=self.tmp_dir.name, emerge_module_rebuild=False)
+
+    def kernels(self, updater):
+        return [(k.version_triple, k.is_old) for k in updater._KernelUpdater__kernels]
+
+    def test_find_installed_kernels(self):
+        # 5.9.2 shouldn't pick up 5.9.20's files and each .old is matched with its own files
+        self.install("5.9.2")
+        self.install("5.9.20")
+        self.install("5.9.20", old=True)
+        kernels = self.kernels(self.updater(versions_to_keep=3))
+        self.assertEqual(kernels, [("5.9.20", False), ("5.9.20", True), ("5.9.2", False)])
+
+    def test_clean_up(self):
+        for version_triple in ("5.9.1", "5.9.10", "5.9.20"):
+            self.install(version_triple)
+        # -rN kernels keep their suffix on the source and modules directories too
+        self.install("5.9.2", release_candidate_num=1)
+        updater = self.updater(versions_to_keep=2)
+        updater._KernelUpdater__clean_up(self.tmp_dir.name)
+
+        self.assertEqual(self.kernels(updater), [("5.9.20", False), ("5.9.10", False)])
+        self.assertEqual(sorted(os.listdir(self.source_path)), ["linux-5.9.10-gentoo", "linux-5.9.20-gentoo"])
+        self.assertEqual(sorted(os.listdir(self.modules_path)), ["5.9.10-gentoo", "5.9.20-gentoo"])
+        self.assertTrue((self.install_path / "grub").is_dir())
+
+    def test_clean_up_nothing_to_delete(self):
+        self.install("5.9.1")
+        self.install("5.9.2")
+        updater = self.updater(versions_to_keep=2)
+        updater._KernelUpdater__clean_up(self.tmp_dir.name)
+        self.assertEqual(self.kernels(updater), [("5.9.2", False), ("5.9.1", False)])
+
+    def test_clean_up_old_keeps_shared_source(self):
+        # The .old shares its source directory with the kept kernel of the same version
+        self.install("5.9.2")
+        self.install("5.9.2", old=True)
+        updater = self.updater(versions_to_keep=1)
+        updater._KernelUpdater__clean_up(self.tmp_dir.name)
+
+        self.assertEqual(self.kernels(updater), [("5.9.2", False)])
+        self.assertEqual(os.listdir(self.source_path), ["linux-5.9.2-gentoo"])
+        self.assertEqual(os.listdir(self.modules_path), ["5.9.2-gentoo"])
+
 
 if __name__ == '__main__':
     unittest.main()